@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""Add ticker columns to ETF tables."""
+
+import argparse
+
+import common
+import etfs
+
+TABLES = [f"{etfs.TABLE_PREFIX}_prices", f"{etfs.TABLE_PREFIX}_amounts"]
+
+
+def main():
+    """Main."""
+    parser = argparse.ArgumentParser(description="Add tickers")
+    parser.add_argument("tickers", nargs="+")
+    args = parser.parse_args()
+    for table in TABLES:
+        common.add_sql_columns(table, args.tickers)
+
+
+if __name__ == "__main__":
+    main()
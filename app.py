@@ -4,7 +4,7 @@
 import asyncio
 import contextlib
 import io
-import os.path
+import os
 import subprocess
 from datetime import datetime, timedelta
 from typing import Awaitable, ClassVar, Iterable
@@ -13,11 +13,11 @@ from zoneinfo import ZoneInfo
 import pandas as pd
 import plotly.io as pio
 from loguru import logger
-from nicegui import run, ui
-from plotly.graph_objects import Figure
+from nicegui import app, run, ui
 
 import balance_etfs
 import common
+import etfs
 import graph_generator
 import i_and_e
 import plot
@@ -27,15 +27,24 @@ SUBPLOT_MARGIN = {"l": 0, "r": 50, "b": 0, "t": 50}
 
 RANGES = ["All", "3y", "2y", "1y", "YTD", "6m", "3m", "1m", "1d"]
 DEFAULT_RANGE = "1y"
+GRAPHS_RELOAD_INTERVAL = 60
 
 
 class MainGraphs:
     """Collection of all main graphs."""
 
-    graphs: ClassVar[graph_generator.Graphs] = {}
-    last_updated_time: ClassVar[datetime] = datetime.now()
-    last_generation_duration: ClassVar[timedelta] = timedelta()
-    latest_datapoint_time: ClassVar[pd.Timestamp] = pd.Timestamp.now()
+    # Replaced as a whole so readers never see graphs and stats from different runs.
+    generated: ClassVar[graph_generator.GeneratedGraphs] = (
+        graph_generator.GeneratedGraphs(
+            graphs={},
+            last_updated_time=datetime.now(),
+            last_generation_duration=timedelta(),
+            latest_datapoint_time=pd.Timestamp.now(),
+        )
+    )
+    # When the loaded graphs were generated, 0 until first loaded.
+    generated_time: ClassVar[float] = 0.0
+    graphs_loaded: ClassVar[asyncio.Event] = asyncio.Event()
     LAYOUT: tuple[tuple[str, str], ...] = (
         ("assets_breakdown", "96vh"),
         ("investing_retirement", "75vh"),
@@ -51,61 +60,91 @@ class MainGraphs:
         ("short_options", "50vh"),
         ("daily_indicator", "45vh"),
     )
-    CACHE_CALL_ARGS = (LAYOUT, RANGES, SUBPLOT_MARGIN)
+    CACHE_CALL_ARGS: graph_generator.CacheCallArgs = (
+        LAYOUT,
+        RANGES,
+        SUBPLOT_MARGIN,
+        graph_generator.GRAPHS_FORMAT_VERSION,
+    )
+    HEIGHT_STYLES: ClassVar[dict[str, str]] = {
+        name: f"height: {height}" for name, height in LAYOUT
+    }
 
     @classmethod
-    def all_graphs_populated(cls) -> bool:
-        if graph_generator.generate_all_graphs.check_call_in_cache(
-            *cls.CACHE_CALL_ARGS
+    def load_graphs(cls) -> None:
+        """Load the latest generated graphs from cache, if newer than those loaded."""
+        generated_time = graph_generator.get_generated_time()
+        if (
+            generated_time <= cls.generated_time
+            or not graph_generator.generate_all_graphs.check_call_in_cache(
+                *cls.CACHE_CALL_ARGS
+            )
         ):
-            (
-                cls.graphs,
-                cls.last_updated_time,
-                cls.last_generation_duration,
-                cls.latest_datapoint_time,
-            ) = graph_generator.generate_all_graphs(*cls.CACHE_CALL_ARGS)
-            return True
-        elif len(cls.graphs):
-            return True
-        return False
+            return
+        generated = graph_generator.generate_all_graphs(*cls.CACHE_CALL_ARGS)
+        # Not retried until the next generation, whether loaded or rejected.
+        cls.generated_time = generated_time
+        if not isinstance(generated, graph_generator.GeneratedGraphs):
+            logger.error(f"Ignoring cached graphs of type {type(generated)}")
+            return
+        cls.generated = generated
+
+    @classmethod
+    def all_graphs_populated(cls) -> bool:
+        return len(cls.generated.graphs) > 0
 
     def __init__(self, selected_range: str):
         self.ui_plotly = {}
         self.ui_stats_labels = {}
         self.selected_range = selected_range
-
-    async def update_stats_labels(self) -> None:
-        try:
-            timezone = ZoneInfo(
-                await ui.run_javascript(
-                    "Intl.DateTimeFormat().resolvedOptions().timeZone", timeout=10
+        self.timezone: ZoneInfo | None = None
+
+    async def get_timezone(self) -> ZoneInfo:
+        """Get client timezone, asking the browser only once."""
+        if self.timezone is None:
+            try:
+                self.timezone = ZoneInfo(
+                    await ui.run_javascript(
+                        "Intl.DateTimeFormat().resolvedOptions().timeZone", timeout=10
+                    )
                 )
-            )
-        except TimeoutError:
-            timezone = ZoneInfo("UTC")
+            except TimeoutError:
+                return ZoneInfo("UTC")
+        return self.timezone
+
+    async def update_stats_labels(
+        self, generated: graph_generator.GeneratedGraphs
+    ) -> None:
+        timezone = await self.get_timezone()
         self.ui_stats_labels["last_datapoint_time"].set_text(
-            f"Latest datapoint: {MainGraphs.latest_datapoint_time.tz_localize('UTC').astimezone(timezone).strftime('%c')}"
+            f"Latest datapoint: {generated.latest_datapoint_time.tz_localize('UTC').astimezone(timezone).strftime('%c')}"
         )
         self.ui_stats_labels["last_updated_time"].set_text(
-            f"Graphs last updated: {MainGraphs.last_updated_time.astimezone(timezone).strftime('%c')}"
+            f"Graphs last updated: {generated.last_updated_time.astimezone(timezone).strftime('%c')}"
         )
         self.ui_stats_labels["last_generation_duration"].set_text(
-            f"Graph generation duration: {MainGraphs.last_generation_duration.total_seconds():.2f}s"
+            f"Graph generation duration: {generated.last_generation_duration.total_seconds():.2f}s"
         )
 
     async def create(self) -> None:
         """Create all graphs."""
-        for name, height in MainGraphs.LAYOUT:
-            if name in MainGraphs.graphs["ranged"]:
-                graph = MainGraphs.graphs["ranged"][name][self.selected_range]
+        generated = MainGraphs.generated
+        for name, style in MainGraphs.HEIGHT_STYLES.items():
+            if name in generated.graphs["ranged"]:
+                graph = generated.graphs["ranged"][name][self.selected_range]
             else:
                 try:
-                    graph = MainGraphs.graphs["nonranged"][name]
+                    graph = generated.graphs["nonranged"][name]
                 except KeyError:
                     continue
-            self.ui_plotly[name] = (
-                ui.plotly(graph).classes("w-full").style(f"height: {height}")
-            )
+            # Only mount graphs once they are scrolled into view.
+            with (
+                ui.element("q-intersection")
+                .props("once")
+                .classes("w-full")
+                .style(style)
+            ):
+                self.ui_plotly[name] = ui.plotly(graph).classes("w-full").style(style)
         with ui.row().classes("flex justify-center w-full"):
             for label in [
                 "last_datapoint_time",
@@ -115,57 +154,102 @@ class MainGraphs:
             ]:
                 self.ui_stats_labels[label] = ui.label()
             ui.link("Static Images", "/image_only")
-        await self.update_stats_labels()
+        await self.update_stats_labels(generated)
 
     async def update(self) -> None:
         """Update all graphs."""
-        for name in MainGraphs.graphs["ranged"]:
-            await run.io_bound(
-                self.ui_plotly[name].update_figure,
-                MainGraphs.graphs["ranged"][name][self.selected_range],
+        generated = MainGraphs.generated
+        for name in generated.graphs["ranged"]:
+            self.ui_plotly[name].update_figure(
+                generated.graphs["ranged"][name][self.selected_range]
             )
-        await self.update_stats_labels()
+        await self.update_stats_labels(generated)
 
 
 class IncomeExpenseGraphs:
     """Collection of all income & expense graphs."""
 
-    def get_graphs(self) -> Iterable[Awaitable[Figure]]:
-        """Generate Plotly graphs. This calls subprocess."""
+    @staticmethod
+    def get_dataframes() -> tuple[pd.DataFrame, ...]:
+        """Get ledger dataframes, with each category filtered once for all charts.
+
+        This calls subprocess.
+        """
         ledger_df, ledger_summarized_df = i_and_e.get_ledger_dataframes()
+        return (
+            ledger_df,
+            ledger_summarized_df,
+            i_and_e.get_dataframe(ledger_df, "Income"),
+            i_and_e.get_dataframe(ledger_df, "Expenses"),
+            i_and_e.get_dataframe(ledger_summarized_df, "Income"),
+            i_and_e.get_dataframe(ledger_summarized_df, "Expenses"),
+        )
+
+    async def get_graphs(self) -> Iterable[Awaitable[dict]]:
+        """Generate Plotly graphs."""
+        (
+            ledger_df,
+            ledger_summarized_df,
+            income_df,
+            expenses_df,
+            income_summarized_df,
+            expenses_summarized_df,
+        ) = await run.io_bound(self.get_dataframes)
         funcs = (
             lambda: i_and_e.get_income_expense_yearly_chart(ledger_summarized_df),
+            lambda: i_and_e.get_yearly_chart(income_summarized_df, "Yearly Income"),
+            lambda: i_and_e.get_yearly_chart(expenses_summarized_df, "Yearly Expenses"),
             lambda: i_and_e.get_yearly_chart(
-                ledger_summarized_df, "Income", "Yearly Income"
-            ),
-            lambda: i_and_e.get_yearly_chart(
-                ledger_summarized_df, "Expenses", "Yearly Expenses"
-            ),
-            lambda: i_and_e.get_yearly_chart(
-                ledger_df, "Expenses", "Yearly Expenses Categorized"
+                expenses_df, "Yearly Expenses Categorized"
             ),
             lambda: i_and_e.get_income_expense_monthly_chart(ledger_summarized_df),
+            lambda: i_and_e.get_monthly_chart(income_summarized_df, "Monthly Income"),
             lambda: i_and_e.get_monthly_chart(
-                ledger_summarized_df, "Income", "Monthly Income"
-            ),
-            lambda: i_and_e.get_monthly_chart(
-                ledger_summarized_df, "Expenses", "Monthly Expenses"
-            ),
-            lambda: i_and_e.get_monthly_chart(
-                ledger_df, "Income", "Monthly Income Categorized"
+                expenses_summarized_df, "Monthly Expenses"
             ),
+            lambda: i_and_e.get_monthly_chart(income_df, "Monthly Income Categorized"),
             lambda: i_and_e.get_monthly_chart(
-                ledger_df, "Expenses", "Monthly Expenses Categorized"
+                expenses_df, "Monthly Expenses Categorized"
             ),
             lambda: i_and_e.get_average_monthly_income_expenses_chart(ledger_df),
-            lambda: i_and_e.get_average_monthly_top_expenses(ledger_df),
+            lambda: i_and_e.get_average_monthly_top_expenses(expenses_df),
         )
-        return (run.io_bound(f) for f in funcs)
+        # Convert to plotly json in the worker threads rather than on the event loop.
+        return (run.io_bound(lambda f=f: f().to_plotly_json()) for f in funcs)
 
     async def create(self):
-        """Create all graphs."""
-        for graph in self.get_graphs():
-            ui.plotly(await graph).classes("w-full").style("height: 50vh")
+        """Create all graphs, showing each one as soon as it is ready."""
+
+        async def fill(container: ui.element, graph: Awaitable[dict]) -> None:
+            figure = await graph
+            container.clear()
+            with container:
+                ui.plotly(figure).classes("w-full").style("height: 50vh")
+
+        fills = []
+        for graph in await self.get_graphs():
+            with ui.element().classes("w-full") as container:
+                ui.skeleton().classes("w-full").style("height: 50vh")
+            fills.append(fill(container, graph))
+        await asyncio.gather(*fills)
+
+
+async def load_graphs_loop():
+    """Keep graphs loaded in memory so pages never wait on the disk cache."""
+    while True:
+        populated = False
+        try:
+            await run.io_bound(MainGraphs.load_graphs)
+            populated = MainGraphs.all_graphs_populated()
+        # pylint: disable-next=broad-exception-caught
+        except Exception:
+            # For example the cache being cleared while regenerating. Retry later.
+            logger.exception("Failed to load graphs")
+        if populated:
+            MainGraphs.graphs_loaded.set()
+            await asyncio.sleep(GRAPHS_RELOAD_INTERVAL)
+        else:
+            await asyncio.sleep(1)
 
 
 def log_request():
@@ -191,14 +275,14 @@ async def main_page():
     )
 
     async def wait_for_graphs():
-        skel = None
-        while not MainGraphs.all_graphs_populated():
+        if not MainGraphs.graphs_loaded.is_set():
             await ui.context.client.connected()
-            if not skel:
-                skel = ui.skeleton("QToolbar").classes("w-full")
-            await asyncio.sleep(1)
-        if skel:
-            skel.delete()
+            # Show the static images until the interactive graphs are ready.
+            with ui.column().classes("w-full") as placeholder:
+                ui.skeleton("QToolbar").classes("w-full")
+                MainGraphsImageOnly(DEFAULT_RANGE).add_images()
+            await MainGraphs.graphs_loaded.wait()
+            placeholder.delete()
 
     await wait_for_graphs()
 
@@ -219,21 +303,31 @@ class MainGraphsImageOnly:
         self.ui_image = {}
         self.selected_range = selected_range
         self.latest_timestamp = datetime.fromtimestamp(0)
+        self.mtimes = self.image_mtimes()
+
+    @staticmethod
+    def image_mtimes() -> dict[str, float]:
+        """Get modification times of all images with a single directory scan."""
+        with os.scandir(common.PREFIX) as entries:
+            return {
+                e.name: e.stat().st_mtime for e in entries if e.name.endswith(".png")
+            }
+
+    def add_images(self) -> None:
+        """Add just the images, in layout order."""
+        for name, _ in MainGraphs.LAYOUT:
+            for filename in [f"{name}.png", f"{name}-{self.selected_range}.png"]:
+                if filename in self.mtimes:
+                    self.ui_image[name] = ui.image(f"{common.PREFIX}/{filename}")
+                    if (
+                        ts := datetime.fromtimestamp(self.mtimes[filename])
+                    ) > self.latest_timestamp:
+                        self.latest_timestamp = ts
+                    break
 
     def images(self) -> None:
         with ui.column().classes("w-full"):
-            for name, _ in MainGraphs.LAYOUT:
-                for path in [
-                    f"{common.PREFIX}/{name}.png",
-                    f"{common.PREFIX}/{name}-{self.selected_range}.png",
-                ]:
-                    if os.path.exists(path):
-                        self.ui_image[name] = ui.image(path)
-                        if (
-                            ts := datetime.fromtimestamp(os.path.getmtime(path))
-                        ) > self.latest_timestamp:
-                            self.latest_timestamp = ts
-                        break
+            self.add_images()
             with ui.row().classes("flex justify-center w-full"):
                 ui.label(
                     f"Latest image timestamp: {self.latest_timestamp.strftime('%c')}"
@@ -242,10 +336,8 @@ class MainGraphsImageOnly:
 
     def update(self) -> None:
         for name, _ in MainGraphs.LAYOUT:
-            if os.path.exists(
-                path := f"{common.PREFIX}/{name}-{self.selected_range}.png"
-            ):
-                self.ui_image[name].set_source(path)
+            if (filename := f"{name}-{self.selected_range}.png") in self.mtimes:
+                self.ui_image[name].set_source(f"{common.PREFIX}/{filename}")
 
 
 @ui.page("/image_only")
@@ -272,22 +364,30 @@ async def i_and_e_page():
     skel.delete()
 
 
+# The report includes live option quotes, which are cached for 30 minutes.
+@common.cache_until_modified(
+    common.LEDGER_DAT,
+    common.LEDGER_PRICES_DB,
+    etfs.CSV_OUTPUT_PATH,
+    max_age=timedelta(minutes=30),
+)
 def get_stock_options_output() -> str:
+    """Get stock options report, cached until its inputs change or it expires."""
     with contextlib.redirect_stdout(io.StringIO()) as output:
         with common.pandas_options():
             stock_options.main()
             return output.getvalue()
 
 
-@ui.page("/stock_options", title="Stock Options")
-async def stock_options_page():
-    """Stock options."""
-    log_request()
-    skel = ui.skeleton("QToolbar").classes("w-full")
-    await ui.context.client.connected()
-    ui.html(f"<PRE>{await run.io_bound(get_stock_options_output)}</PRE>")
+@common.cache_until_modified(
+    common.SQLITE_DB, common.LEDGER_DAT, common.LEDGER_PRICES_DB
+)
+def get_index_prices_figure() -> dict:
+    """Get index prices graph with SPX strikes, cached until its inputs change."""
     fig = plot.make_prices_section(
-        common.read_sql_table("index_prices").sort_index(), "Index Prices"
+        common.read_sql_table_sorted("index_prices"),
+        "Index Prices",
+        render_mode="webgl",
     ).update_layout(margin=SUBPLOT_MARGIN)
 
     options_df = stock_options.options_df_raw().loc[
@@ -299,17 +399,34 @@ async def stock_options_page():
             annotation_text=f"{row['count']} {row['name']}",
             annotation_position="top left",
         )
+    return fig.to_plotly_json()
+
 
+@ui.page("/stock_options", title="Stock Options")
+async def stock_options_page():
+    """Stock options."""
+    log_request()
+    skel = ui.skeleton("QToolbar").classes("w-full")
+    await ui.context.client.connected()
+    ui.html(f"<PRE>{await run.io_bound(get_stock_options_output)}</PRE>")
+    fig = await run.io_bound(get_index_prices_figure)
     ui.plotly(fig).classes("w-full").style("height: 50vh")
     skel.delete()
 
 
+# The script's queries are relative to the current time, so expire it as well.
+@common.cache_until_modified(common.SQLITE_DB, max_age=timedelta(minutes=5))
+def get_latest_values_output() -> str:
+    """Get latest values script output, cached briefly or until the database changes."""
+    return subprocess.check_output(f"{common.CODE_DIR}/latest_values.sh", text=True)
+
+
 @ui.page("/latest_values", title="Latest Values")
-def latest_values_page():
+async def latest_values_page():
     """Latest values."""
     log_request()
-    output = subprocess.check_output(f"{common.CODE_DIR}/latest_values.sh", text=True)
-    ui.html(f"<PRE>{output}</PRE>")
+    await ui.context.client.connected()
+    ui.html(f"<PRE>{await run.io_bound(get_latest_values_output)}</PRE>")
 
 
 @ui.page("/balance_etfs", title="Balance ETFs")
@@ -324,6 +441,7 @@ def balance_etfs_page(amount: int = 0):
 
 if __name__ in {"__main__", "__mp_main__"}:
     pio.templates.default = common.PLOTLY_THEME
+    app.on_startup(load_graphs_loop)
     ui.run(
         title="Accounts",
         dark=True,
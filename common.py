@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 """Common functions."""
 
+import functools
 import multiprocessing
 import os
 import shutil
 import subprocess
 import tempfile
+import time
 import typing
 from contextlib import contextmanager
+from datetime import timedelta
 from functools import reduce
 from pathlib import Path
 from typing import Mapping, NamedTuple, Sequence
@@ -27,7 +30,8 @@ PUBLIC_HTML = f"{CODE_DIR}/web/"
 PREFIX = PUBLIC_HTML
 LOCKFILE = f"{PREFIX}/run.lock"
 LOCKFILE_TIMEOUT = 10 * 60
-SQLITE_URI = f"sqlite:///{PREFIX}sqlite.db"
+SQLITE_DB = f"{PREFIX}sqlite.db"
+SQLITE_URI = f"sqlite:///{SQLITE_DB}"
 SQLITE_URI_RO = f"sqlite:///file:{PREFIX}sqlite.db?mode=ro&uri=true"
 SQLITE3_URI_RO = f"file:{PREFIX}sqlite.db?mode=ro"
 SELENIUM_REMOTE_URL = "http://selenium:4444"
@@ -68,6 +72,36 @@ cache_decorator = Memory(f"{PREFIX}cache", verbose=0).cache(
 cache_forever_decorator = Memory(f"{PREFIX}cache", verbose=0).cache()
 
 
+def cache_until_modified(*paths: str, max_age: timedelta | None = None):
+    """Cache function results in memory until any of the files in paths change.
+
+    With max_age, results also expire after that long, for functions that depend
+    on more than the files. Only the latest result per arguments is kept, so
+    results for old file versions are dropped instead of accumulating.
+    """
+
+    def decorator(func):
+        results = {}
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            mtimes = tuple(os.path.getmtime(path) for path in paths)
+            now = time.monotonic()
+            if (
+                (cached := results.get(args))
+                and cached[0] == mtimes
+                and (max_age is None or now - cached[1] < max_age.total_seconds())
+            ):
+                return cached[2]
+            result = func(*args)
+            results[args] = (mtimes, now, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 @contextmanager
 def pandas_options():
     """Set pandas output options."""
@@ -107,7 +141,9 @@ def log_function_result(name, success, error_string=None):
 def get_ticker_option(
     ticker: str, expiration: pd.Timestamp, contract_type: str, strike: float
 ) -> float | None:
-    name = expiration.strftime(f"{ticker}%y%m%d{contract_type[0]}{int(strike*1000):08}")
+    name = expiration.strftime(
+        f"{ticker}%y%m%d{contract_type[0]}{int(strike * 1000):08}"
+    )
     logger.info(f"Retrieving option quote {ticker=} {name=}")
     if not isinstance(
         option_chain := yahooquery.Ticker(ticker).option_chain, pd.DataFrame
@@ -166,12 +202,19 @@ def get_ticker_yfinance(ticker: str) -> float:
     return yfinance.Ticker(ticker).history(period="5d")["Close"].iloc[-1]
 
 
-def read_sql_table(table, index_col="date"):
-    """Load table from sqlite."""
+@cache_until_modified(SQLITE_DB)
+def read_sql_table_cached(table, index_col):
+    """Load table from sqlite, cached in memory until the database changes."""
     with create_engine(SQLITE_URI_RO).connect() as conn:
         return pd.read_sql_table(table, conn, index_col=index_col)
 
 
+def read_sql_table(table, index_col="date"):
+    """Load table from sqlite."""
+    # Copy, as callers are free to modify the returned dataframe.
+    return read_sql_table_cached(table, index_col).copy()
+
+
 def read_sql_query(query):
     """Load table from sqlite query."""
     with create_engine(SQLITE_URI_RO).connect() as conn:
@@ -183,6 +226,22 @@ def read_sql_query(query):
         )
 
 
+def read_sql_table_sorted(table: str) -> pd.DataFrame:
+    """Load table of FLOAT columns from sqlite, sorted by date."""
+    # A query does not carry declared column types, so an all-NULL column, such as
+    # a newly added ticker, would otherwise load as object.
+    return read_sql_query(f'select * from "{table}" order by date').astype("float64")
+
+
+def get_sql_columns(table: str) -> list[str]:
+    """Get stored column names of sqlite table. Generated columns are not listed."""
+    with create_engine(SQLITE_URI_RO).connect() as conn:
+        return [
+            row[1]
+            for row in conn.execute(sqlalchemy_text(f'PRAGMA table_info("{table}")'))
+        ]
+
+
 def read_sql_last(table: str) -> pd.DataFrame:
     return read_sql_query(f"select * from {table} order by date desc limit 1")
 
@@ -196,6 +255,18 @@ def to_sql(dataframe, table, if_exists="append", index_label="date", foreign_key
         conn.commit()
 
 
+def add_sql_columns(table: str, columns: Sequence[str], column_type: str = "FLOAT"):
+    """Add columns to sqlite table in a single transaction."""
+    with create_engine(SQLITE_URI).connect() as conn:
+        for column in columns:
+            conn.execute(
+                sqlalchemy_text(
+                    f'ALTER TABLE "{table}" ADD COLUMN "{column}" {column_type}'
+                )
+            )
+        conn.commit()
+
+
 def write_ticker_sql(
     amounts_table: str,
     prices_table: str,
@@ -325,17 +396,19 @@ def get_real_estate_df():
     )
 
 
+@cache_until_modified(LEDGER_DAT, LEDGER_PRICES_DB)
+def get_ledger_output(command: str) -> str:
+    """Get ledger command output, cached until the journal or prices change."""
+    return subprocess.check_output(command, shell=True, text=True)
+
+
 def get_ledger_balance(command):
     """Get account balance from ledger."""
     try:
-        return float(
-            subprocess.check_output(
-                f"{command} | tail -1", shell=True, text=True
-            ).split()[1]
-        )
+        return float(get_ledger_output(command).splitlines()[-1].split()[1])
     except IndexError:
         return 0
 
 
 if __name__ == "__main__":
-    print(f'{get_ticker("SWYGX")}')
+    print(f"{get_ticker('SWYGX')}")
@@ -1,8 +1,12 @@
+import functools
+import os
 import typing
 from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Callable, Literal, Mapping
+from pathlib import Path
+from typing import Callable, Literal, Mapping, NamedTuple
 
+import joblib
 import pandas as pd
 import plotly.io as pio
 from dateutil.relativedelta import relativedelta
@@ -17,59 +21,159 @@ import stock_options
 type NonRangedGraphs = dict[str, dict]
 type RangedGraphs = dict[str, dict[str, dict]]
 type Graphs = dict[Literal["ranged", "nonranged"], NonRangedGraphs | RangedGraphs]
+type CacheCallArgs = tuple[tuple[tuple[str, str], ...], list[str], dict[str, int], int]
+
+
+class GeneratedGraphs(NamedTuple):
+    graphs: Graphs
+    last_updated_time: datetime
+    last_generation_duration: timedelta
+    latest_datapoint_time: pd.Timestamp
+
+
+PLOT_CACHE_AGE_LIMIT = timedelta(days=7)
+
+# Part of the generate_all_graphs cache key. Bump when its result changes shape, so
+# entries pickled by older code are never loaded.
+GRAPHS_FORMAT_VERSION = 1
+
+# Touched after each generation, so readers can tell when new graphs are cached.
+GENERATED_MARKER = f"{common.PREFIX}graphs_generated"
+
+# Kaleido keeps one renderer process per worker; skip loading MathJax into it.
+pio.kaleido.scope.mathjax = None  # type: ignore
+
+plot_memory = Memory(f"{common.PREFIX}plot_cache", verbose=0)
+
+# Ranges that start relative to the latest datapoint.
+RANGE_OFFSETS = {
+    "3y": relativedelta(years=-3),
+    "2y": relativedelta(years=-2),
+    "1y": relativedelta(years=-1),
+    "6m": relativedelta(months=-6),
+    "3m": relativedelta(months=-3),
+    "1m": relativedelta(months=-1),
+    "1d": relativedelta(days=-1),
+}
+
+# Graphs with a range selector: name, source dataframe, columns to plot (None for
+# all) and the function building the figure from the resampled dataframe.
+RANGED_GRAPHS: tuple[
+    tuple[str, str, list[str] | None, Callable[[pd.DataFrame], Figure]], ...
+] = (
+    ("assets_breakdown", "all", None, plot.make_assets_breakdown_section),
+    (
+        "investing_retirement",
+        "all",
+        ["pillar2", "ira", "commodities", "etfs"],
+        plot.make_investing_retirement_section,
+    ),
+    ("real_estate", "real_estate", None, plot.make_real_estate_section),
+    (
+        "prices",
+        "prices",
+        None,
+        functools.partial(plot.make_prices_section, title="Prices"),
+    ),
+    ("forex", "forex", None, functools.partial(plot.make_forex_section, title="Forex")),
+    ("interest_rate", "interest_rate", None, plot.make_interest_rate_section),
+)
+
+# Graphs without a range selector: name, source dataframes passed to the builder,
+# whether to apply the subplot margin and the function building the figure.
+NONRANGED_GRAPHS: tuple[
+    tuple[str, tuple[str, ...], bool, Callable[..., Figure]], ...
+] = (
+    (
+        "allocation_profit",
+        ("all", "real_estate"),
+        True,
+        plot.make_allocation_profit_section,
+    ),
+    (
+        "change",
+        ("all",),
+        False,
+        functools.partial(
+            plot.make_change_section, column="total", title="Total Net Worth Change"
+        ),
+    ),
+    (
+        "change_no_homes",
+        ("all",),
+        False,
+        functools.partial(
+            plot.make_change_section,
+            column="total_no_homes",
+            title="Total Net Worth Change w/o Real Estate",
+        ),
+    ),
+    ("investing_allocation", (), False, plot.make_investing_allocation_section),
+    ("loan", (), True, plot.make_loan_section),
+    ("daily_indicator", ("all",), False, plot.make_daily_indicator),
+    ("short_options", ("options",), True, plot.make_short_options_section),
+)
 
 
 def get_xrange(
-    dataframe: pd.DataFrame, selected_range: str
+    dataframe: pd.DataFrame, selected_range: str, today_time: datetime | None = None
 ) -> tuple[str | datetime, str | datetime] | None:
     """Determine time range for selected button."""
     latest_time = dataframe.index[-1]
-    earliest_time = dataframe.index[0]
-    today_time = datetime.now()
-    xrange = None
-    relative = None
     match selected_range:
         case "All":
-            xrange = (earliest_time, latest_time)
-        case "3y":
-            relative = relativedelta(years=-3)
-        case "2y":
-            relative = relativedelta(years=-2)
-        case "1y":
-            relative = relativedelta(years=-1)
+            return (dataframe.index[0], latest_time)
         case "YTD":
-            xrange = (today_time.strftime("%Y-01-01"), latest_time)
-        case "6m":
-            relative = relativedelta(months=-6)
-        case "3m":
-            relative = relativedelta(months=-3)
-        case "1m":
-            relative = relativedelta(months=-1)
-        case "1d":
-            relative = relativedelta(days=-1)
-    if relative:
-        xrange = ((latest_time + relative), latest_time)
-    return xrange
-
-
-def limit_and_resample_df(df: pd.DataFrame, selected_range: str) -> pd.DataFrame:
-    """Limit df to selected range and resample."""
-    if (retval := get_xrange(df, selected_range)) is None:
-        return df
-    start, end = retval
-    df = df[start:end]
+            if today_time is None:
+                today_time = datetime.now()
+            return (today_time.strftime("%Y-01-01"), latest_time)
+    if (relative := RANGE_OFFSETS.get(selected_range)) is None:
+        return None
+    return ((latest_time + relative), latest_time)
+
+
+def get_resample_window(selected_range: str) -> str | None:
+    """Get resampling window for selected range."""
     match selected_range:
         case "1m" | "1d":
-            window = None
+            return None
         case "All" | "3y" | "2y":
-            window = "W"
+            return "W"
         case _:
-            window = "D"
-    if window:
-        return df.resample(window).last().interpolate()
-    return df
+            return "D"
+
+
+def resample_windows(df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """Resample df once for every window used by the ranges."""
+    return {window: df.resample(window).last().interpolate() for window in ("W", "D")}
+
+
+def limit_and_resample_df(
+    df: pd.DataFrame,
+    selected_range: str,
+    windows: Mapping[str, pd.DataFrame],
+    today_time: datetime,
+) -> pd.DataFrame:
+    """Limit df to selected range, using its resampled windows where needed."""
+    if (retval := get_xrange(df, selected_range, today_time)) is None:
+        return df
+    start, end = retval
+    if (window := get_resample_window(selected_range)) is None:
+        return df[start:end]
+    # Bins are labelled at midnight so include the one containing start. The last
+    # bin is labelled after end, so only limit the start.
+    return windows[window][pd.Timestamp(start).floor("D") :]
+
 
+def downcast_floats(df: pd.DataFrame) -> pd.DataFrame:
+    """Store float columns as float32, which is plenty for plotted quotes.
 
+    Not used for history, where totals need float64 to keep cents.
+    """
+    return df.astype({c: "float32" for c in df.select_dtypes("float64").columns})
+
+
+@functools.cache
 def get_plot_height_percent(name: str, layout: tuple[tuple[str, str], ...]) -> float:
     for n, height in layout:
         if n == name:
@@ -78,32 +182,67 @@ def get_plot_height_percent(name: str, layout: tuple[tuple[str, str], ...]) -> f
 
 
 def plot_generate(
-    name: str, plot_func: Callable[[], Figure], layout: tuple[tuple[str, str], ...]
-) -> tuple[str, dict]:
+    name: str,
+    plot_func: Callable[..., Figure],
+    dfs: tuple[pd.DataFrame, ...],
+    subplot_margin: dict[str, int] | None,
+    layout: tuple[tuple[str, str], ...],
+) -> tuple[str, None, dict]:
     pio.templates.default = common.PLOTLY_THEME
-    fig = plot_func()
-    write_image(fig, name, f"{common.PREFIX}/{name}.png", layout)
-    return name, fig.to_plotly_json()
+    figure = plot_func(*dfs)
+    if subplot_margin:
+        figure.update_layout(margin=subplot_margin)
+    figure = figure.to_plotly_json()
+    write_image(figure, name, f"{common.PREFIX}/{name}.png", layout)
+    return name, None, figure
+
+
+# Graphs are drawn by plot.py, so its source is part of every ranged figure's key.
+PLOT_CODE_VERSION = joblib.hash(Path(plot.__file__).read_bytes())
+
+
+# A ranged figure is determined by its name, builder with any bound arguments,
+# data and plot code, so unchanged data skips plotting. Builders are module
+# functions or partials of them, which hash by reference and arguments.
+@plot_memory.cache
+def plot_ranged(
+    name: str,
+    plot_func: Callable[[pd.DataFrame], Figure],
+    df: pd.DataFrame,
+    subplot_margin: dict[str, int],
+    plot_code_version: str,
+) -> dict:
+    pio.templates.default = common.PLOTLY_THEME
+    return plot_func(df).update_layout(margin=subplot_margin).to_plotly_json()
 
 
 def plot_generate_ranged(
     name: str,
-    plot_func: Callable[[str], Figure],
-    r: str,
+    plot_func: Callable[[pd.DataFrame], Figure],
+    df: pd.DataFrame,
+    ranges: tuple[str, ...],
+    subplot_margin: dict[str, int],
     layout: tuple[tuple[str, str], ...],
-) -> tuple[str, dict]:
-    pio.templates.default = common.PLOTLY_THEME
-    fig = plot_func(r)
-    write_image(fig, name, f"{common.PREFIX}/{name}-{r}.png", layout)
-    return name, fig.to_plotly_json()
+) -> tuple[str, tuple[str, ...], dict]:
+    figure = plot_ranged(name, plot_func, df, subplot_margin, PLOT_CODE_VERSION)
+    # Always written, so missing images are recreated. Unchanged ones are skipped.
+    for r in ranges:
+        write_image(figure, name, f"{common.PREFIX}/{name}-{r}.png", layout)
+    return name, ranges, figure
 
 
-def write_image(fig: Figure, name: str, path: str, layout: tuple[tuple[str, str], ...]):
-    fig.write_image(
-        path,
-        width=1024,
-        height=768 * get_plot_height_percent(name, layout),
-    )
+def write_image(
+    figure: dict, name: str, path: str, layout: tuple[tuple[str, str], ...]
+):
+    """Write image, skipping it if the figure is unchanged since the last write."""
+    height = 768 * get_plot_height_percent(name, layout)
+    digest = joblib.hash((figure, height))
+    hash_path = Path(f"{path}.hash")
+    if os.path.exists(path) and hash_path.exists() and hash_path.read_text() == digest:
+        return
+    # The dict comes from a built Figure, so it does not need validating again.
+    pio.write_image(figure, path, width=1024, height=height, validate=False)
+    hash_path.write_text(digest)
 
 
 @common.cache_forever_decorator
@@ -111,154 +250,117 @@ def generate_all_graphs(
     layout: tuple[tuple[str, str], ...],
     ranges: list[str],
     subplot_margin: dict[str, int],
-) -> tuple[Graphs, datetime, timedelta, pd.Timestamp]:
+    format_version: int,
+) -> GeneratedGraphs:
     """Generate and save all Plotly graphs."""
     logger.info("Generating graphs")
     start_time = datetime.now()
-    dataframes = {
-        "all": common.read_sql_table("history").sort_index(),
-        "real_estate": common.get_real_estate_df(),
-        "prices": (common.read_sql_table("schwab_etfs_prices").sort_index()),
-        "forex": common.read_sql_table("forex").sort_index(),
-        "interest_rate": plot.get_interest_rate_df(),
-        "options": stock_options.options_df(),
-    }
-    nonranged_graphs_generate = [
-        (
-            "allocation_profit",
-            lambda: plot.make_allocation_profit_section(
-                dataframes["all"],
-                dataframes["real_estate"],
-            ).update_layout(margin=subplot_margin),
-        ),
-        (
-            "change",
-            lambda: plot.make_change_section(
-                dataframes["all"],
-                "total",
-                "Total Net Worth Change",
-            ),
+    loaders: dict[str, Callable[[], pd.DataFrame]] = {
+        "all": lambda: common.read_sql_table_sorted("history"),
+        "real_estate": common.get_real_estate_df,
+        "prices": lambda: downcast_floats(
+            common.read_sql_table_sorted("schwab_etfs_prices").sort_index(axis=1)
         ),
-        (
-            "change_no_homes",
-            lambda: plot.make_change_section(
-                dataframes["all"],
-                "total_no_homes",
-                "Total Net Worth Change w/o Real Estate",
+        "forex": lambda: downcast_floats(common.read_sql_table_sorted("forex")),
+        "interest_rate": plot.get_interest_rate_df,
+        "options": stock_options.options_df,
+    }
+    # Loading is mostly sqlite and ledger I/O, so overlap it in threads.
+    dataframes = dict(
+        zip(
+            loaders,
+            Parallel(n_jobs=len(loaders), prefer="threads")(
+                delayed(loader)() for loader in loaders.values()
             ),
-        ),
-        (
-            "investing_allocation",
-            lambda: plot.make_investing_allocation_section(),
-        ),
-        (
-            "loan",
-            lambda: plot.make_loan_section().update_layout(margin=subplot_margin),
-        ),
-        (
-            "daily_indicator",
-            lambda: plot.make_daily_indicator(dataframes["all"]),
-        ),
-    ]
-    if len(dataframes["options"]):
-        nonranged_graphs_generate.append(
-            (
-                "short_options",
-                lambda: plot.make_short_options_section(
-                    dataframes["options"]
-                ).update_layout(margin=subplot_margin),
-            )
         )
-    ranged_graphs_generate = [
-        (
-            "assets_breakdown",
-            lambda range: plot.make_assets_breakdown_section(
-                limit_and_resample_df(dataframes["all"], range)
-            ).update_layout(margin=subplot_margin),
-        ),
-        (
-            "investing_retirement",
-            lambda range: plot.make_investing_retirement_section(
-                limit_and_resample_df(
-                    dataframes["all"][["pillar2", "ira", "commodities", "etfs"]],
-                    range,
-                )
-            ).update_layout(margin=subplot_margin),
-        ),
-        (
-            "real_estate",
-            lambda range: plot.make_real_estate_section(
-                limit_and_resample_df(
-                    dataframes["real_estate"],
-                    range,
-                )
-            ).update_layout(margin=subplot_margin),
-        ),
-        (
-            "prices",
-            lambda range: plot.make_prices_section(
-                limit_and_resample_df(dataframes["prices"], range).sort_index(axis=1),
-                "Prices",
-            ).update_layout(margin=subplot_margin),
-        ),
-        (
-            "forex",
-            lambda range: plot.make_forex_section(
-                limit_and_resample_df(dataframes["forex"], range),
-                "Forex",
-            ).update_layout(margin=subplot_margin),
-        ),
-        (
-            "interest_rate",
-            lambda range: plot.make_interest_rate_section(
-                limit_and_resample_df(dataframes["interest_rate"], range)
-            ).update_layout(margin=subplot_margin),
-        ),
+    )
+    # Resample each source once per window, in the parent, so that graphs and ranges
+    # sharing a source reuse it and workers only receive the slice they plot. Ranges
+    # that end up with identical slices, such as when history is shorter than the
+    # range, are plotted once.
+    resampled: dict[tuple[str, str], tuple[pd.DataFrame, list[str]]] = {}
+    for source in {source for _, source, _, _ in RANGED_GRAPHS}:
+        windows = resample_windows(dataframes[source])
+        for r in ranges:
+            df = limit_and_resample_df(dataframes[source], r, windows, start_time)
+            resampled.setdefault((source, joblib.hash(df)), (df, []))[1].append(r)
+    tasks = [
+        delayed(plot_generate)(
+            name,
+            plot_func,
+            tuple(dataframes[source] for source in sources),
+            subplot_margin if with_margin else None,
+            layout,
+        )
+        for name, sources, with_margin, plot_func in NONRANGED_GRAPHS
+        if name != "short_options" or len(dataframes["options"])
+    ] + [
+        delayed(plot_generate_ranged)(
+            name,
+            plot_func,
+            df if columns is None else df[columns],
+            tuple(df_ranges),
+            subplot_margin,
+            layout,
+        )
+        for (source, _), (df, df_ranges) in resampled.items()
+        for name, graph_source, columns, plot_func in RANGED_GRAPHS
+        if graph_source == source
     ]
     new_graphs: Graphs = {"ranged": defaultdict(dict), "nonranged": {}}
     with parallel_config(n_jobs=-1):
-        for name, json in typing.cast(
-            tuple,
-            Parallel(return_as="generator_unordered")(
-                delayed(plot_generate)(*args, layout)
-                for args in nonranged_graphs_generate
-            ),
+        for name, graph_ranges, json in typing.cast(
+            tuple, Parallel(return_as="generator_unordered")(tasks)
         ):
-            new_graphs["nonranged"][name] = json
-        for r in ranges:
-            for name, json in typing.cast(
-                tuple,
-                Parallel(return_as="generator_unordered")(
-                    delayed(plot_generate_ranged)(*args, r, layout)
-                    for args in ranged_graphs_generate
-                ),
-            ):
-                new_graphs["ranged"][name][r] = json
+            if graph_ranges is None:
+                new_graphs["nonranged"][name] = json
+            else:
+                for r in graph_ranges:
+                    new_graphs["ranged"][name][r] = json
+
+    plot_memory.reduce_size(age_limit=PLOT_CACHE_AGE_LIMIT)
 
     end_time = datetime.now()
-    cached_graphs = new_graphs
-    last_updated_time = end_time
     last_generation_duration = end_time - start_time
-    latest_datapoint_time = dataframes["all"].index[-1]
     logger.info(f"Graph generation time: {last_generation_duration}")
-    return (
-        cached_graphs,
-        last_updated_time,
-        last_generation_duration,
-        latest_datapoint_time,
+    return GeneratedGraphs(
+        graphs=new_graphs,
+        last_updated_time=end_time,
+        last_generation_duration=last_generation_duration,
+        latest_datapoint_time=dataframes["all"].index[-1],
+    )
+
+
+def get_generated_time() -> float:
+    """Get time graphs were last generated, 0 if never."""
+    try:
+        return os.path.getmtime(GENERATED_MARKER)
+    except FileNotFoundError:
+        return 0.0
+
+
+def get_latest_distinct_history_date() -> pd.Timestamp:
+    """Get date of the latest history row that is not a duplicate of an earlier one."""
+    columns = ", ".join(
+        f'"{column}"'
+        for column in common.get_sql_columns("history")
+        if column != "date"
     )
+    return common.read_sql_query(
+        "select max(date) as date from ("
+        f"select min(date) as date from history group by {columns})"
+    ).index[-1]
 
 
 def use_cached_graphs(metadata: Mapping) -> bool:
-    latest = common.read_sql_table("history").loc[lambda df: ~df.duplicated()].index[-1]
+    latest = get_latest_distinct_history_date()
     return pd.Timestamp.fromtimestamp(metadata["time"]) > latest
 
 
 @Memory(f"{common.PREFIX}cache", verbose=0).cache(
     cache_validation_callback=use_cached_graphs
 )
-def clear_and_generate(
-    cache_call_args: tuple[tuple[tuple[str, str], ...], list[str], dict[str, int]],
-) -> None:
+def clear_and_generate(cache_call_args: CacheCallArgs) -> None:
     generate_all_graphs.clear()
     generate_all_graphs(*cache_call_args)
+    Path(GENERATED_MARKER).touch()
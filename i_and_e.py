@@ -2,7 +2,6 @@
 """Create income and expense graphs."""
 
 import io
-import subprocess
 from datetime import date
 
 import pandas as pd
@@ -19,7 +18,7 @@ TOSHL_EXPENSES_TABLE = "toshl_expenses_export_2023-01-01"
 
 def get_ledger_csv() -> io.StringIO:
     """Get income/expense ledger csv as a StringIO."""
-    return io.StringIO(subprocess.check_output(LEDGER_CSV_CMD, shell=True, text=True))
+    return io.StringIO(common.get_ledger_output(LEDGER_CSV_CMD))
 
 
 def convert_toshl_usd(dataframe: pd.DataFrame) -> pd.DataFrame:
@@ -325,9 +324,8 @@ def get_historical_average_labels() -> tuple[tuple[int, ...], tuple[str, ...]]:
     )
 
 
-def get_average_monthly_top_expenses(ledger_df: pd.DataFrame) -> Figure:
-    """Get average monthly top expenses."""
-    expense_df = get_dataframe(ledger_df, "Expenses")
+def get_average_monthly_top_expenses(expense_df: pd.DataFrame) -> Figure:
+    """Get average monthly top expenses from get_dataframe(..., "Expenses")."""
     months_back, labels = get_historical_average_labels()
     categories = []
     expenses = []
@@ -423,9 +421,8 @@ def get_income_expense_monthly_chart(ledger_df: pd.DataFrame) -> Figure:
     return chart
 
 
-def get_yearly_chart(ledger_df: pd.DataFrame, category_prefix: str, title: str):
-    """Get yearly income or expense bar chart."""
-    dataframe = get_dataframe(ledger_df, category_prefix)
+def get_yearly_chart(dataframe: pd.DataFrame, title: str):
+    """Get yearly income or expense bar chart from get_dataframe()."""
     chart = px.histogram(
         dataframe,
         x=dataframe.index,
@@ -439,9 +436,8 @@ def get_yearly_chart(ledger_df: pd.DataFrame, category_prefix: str, title: str):
     return chart
 
 
-def get_monthly_chart(ledger_df: pd.DataFrame, category_prefix: str, title: str):
-    """Get monthly income or expense bar chart."""
-    dataframe = get_dataframe(ledger_df, category_prefix)
+def get_monthly_chart(dataframe: pd.DataFrame, title: str):
+    """Get monthly income or expense bar chart from get_dataframe()."""
     # Only keep last 12 months.
     dataframe = dataframe[
         dataframe.resample("ME")
@@ -2,7 +2,6 @@
 """Calculate the maximum balance on pledged asset line given a monthly payment."""
 
 import io
-import subprocess
 from typing import Callable
 
 import pandas as pd
@@ -74,7 +73,7 @@ def get_balances_schwab_nonpal() -> tuple[pd.DataFrame, pd.DataFrame]:
 def load_ledger_equity_balance_df(ledger_balance_cmd: str) -> pd.DataFrame:
     """Get dataframe of equity balance."""
     equity_balance_df = pd.read_csv(
-        io.StringIO(subprocess.check_output(ledger_balance_cmd, shell=True, text=True)),
+        io.StringIO(common.get_ledger_output(ledger_balance_cmd)),
         sep=" ",
         index_col=0,
         parse_dates=True,
@@ -82,9 +81,7 @@ def load_ledger_equity_balance_df(ledger_balance_cmd: str) -> pd.DataFrame:
     )
     equity_balance_latest_df = pd.read_csv(
         io.StringIO(
-            subprocess.check_output(
-                ledger_balance_cmd.replace(" reg ", " bal "), shell=True, text=True
-            )
+            common.get_ledger_output(ledger_balance_cmd.replace(" reg ", " bal "))
         ),
         sep=" ",
         index_col=0,
@@ -100,9 +97,7 @@ def load_ledger_equity_balance_df(ledger_balance_cmd: str) -> pd.DataFrame:
 def load_loan_balance_df(ledger_loan_balance_cmd: str) -> pd.DataFrame:
     """Get dataframe of margin loan balance."""
     loan_balance_df = pd.read_csv(
-        io.StringIO(
-            subprocess.check_output(ledger_loan_balance_cmd, shell=True, text=True)
-        ),
+        io.StringIO(common.get_ledger_output(ledger_loan_balance_cmd)),
         sep=" ",
         index_col=0,
         parse_dates=True,
@@ -110,9 +105,7 @@ def load_loan_balance_df(ledger_loan_balance_cmd: str) -> pd.DataFrame:
     )
     loan_balance_latest_df = pd.read_csv(
         io.StringIO(
-            subprocess.check_output(
-                ledger_loan_balance_cmd.replace(" reg ", " bal "), shell=True, text=True
-            )
+            common.get_ledger_output(ledger_loan_balance_cmd.replace(" reg ", " bal "))
         ),
         sep=" ",
         index_col=0,
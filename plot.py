@@ -345,12 +345,15 @@ def make_allocation_profit_section(
     return changes_section
 
 
-def make_prices_section(prices_df: pd.DataFrame, title: str) -> Figure:
+def make_prices_section(
+    prices_df: pd.DataFrame, title: str, render_mode: str = "auto"
+) -> Figure:
     """Make section with prices graphs."""
     fig = px.line(
         prices_df,
         x=prices_df.index,
         y=prices_df.columns,
+        render_mode=render_mode,
     )
     fig.update_yaxes(title_text="USD")
     fig.update_xaxes(title_text="")
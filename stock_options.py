@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 """Methods for stock options."""
 
-import io
-import subprocess
 import typing
 
 import pandas as pd
@@ -17,7 +15,7 @@ def options_df_raw() -> pd.DataFrame:
         + '--no-total --flat --balance-format "%(partial_account)\n%(strip(T))\n"'
     )
     entries = []
-    for line in io.StringIO(subprocess.check_output(cmd, shell=True, text=True)):
+    for line in common.get_ledger_output(cmd).splitlines():
         if line[0].isalpha():
             account = line.strip().split(":")[-1]
             continue